@@ -9,19 +9,27 @@
 # ----- Файл: main.py -----
 
 import os
+import re
+import random
 import asyncio
-from datetime import datetime, timezone
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from dotenv import load_dotenv
 
 import httpx
+import orjson
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.utils.formatting import as_marked_section, Bold
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.client.default import DefaultBotProperties
 import aiosqlite
+import websockets
 
 # Загружаем .env из папки с main.py; если нет .env — пробуем .env.example
 load_dotenv(dotenv_path=Path(__file__).with_name(".env")) or load_dotenv(dotenv_path=Path(__file__).with_name(".env.example"))
@@ -36,65 +44,251 @@ dp = Dispatcher()
 
 # ---- Источники ----
 BINANCE_TICKER = "https://api.binance.com/api/v3/ticker/price?symbol=TONUSDT"
-FX_USD_RUB = "https://api.exchangerate.host/latest?base=USD&symbols=RUB"
+BINANCE_TON_STREAM = "wss://stream.binance.com:9443/ws/tonusdt@bookTicker"
+FX_USD_RUB = "https://open.er-api.com/v6/latest/USD"
 
 # ---- База данных ----
+# Единственное соединение-писатель: открывается в main(), закрывается при остановке.
+DB: aiosqlite.Connection | None = None
+# Соединение общее, поэтому записи (несколько statement + commit) сериализуем
+DB_WRITE_LOCK = asyncio.Lock()
+# Пул read-only соединений для SELECT: в WAL читатели не мешают писателю и друг другу
+READER_POOL_SIZE = os.cpu_count() or 1
+READERS: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+
+# PRAGMA действуют на соединение — выполняем при каждом подключении.
+# journal_mode=WAL хранится в самом файле БД, его включает init_db().
+CONN_PRAGMAS = """
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout=5000;
+PRAGMA temp_store=memory;
+PRAGMA cache_size=-20000;
+"""
+
+async def open_db() -> aiosqlite.Connection:
+    db = await aiosqlite.connect(DB_PATH)
+    await db.executescript(CONN_PRAGMAS)
+    return db
+
+async def open_readers():
+    uri = Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+    for _ in range(READER_POOL_SIZE):
+        db = await aiosqlite.connect(uri, uri=True)
+        await db.executescript(CONN_PRAGMAS)
+        READERS.put_nowait(db)
+
+async def close_readers():
+    while not READERS.empty():
+        await READERS.get_nowait().close()
+
+@asynccontextmanager
+async def acquire_reader():
+    db = await READERS.get()
+    try:
+        yield db
+    finally:
+        READERS.put_nowait(db)
+
+# Одна подписка каждого вида на пользователя — (user_id, kind) и есть первичный ключ.
+# WITHOUT ROWID: строки лежат прямо в B-дереве ключа, без rowid и sqlite_sequence.
+SUBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    kind TEXT NOT NULL CHECK(kind IN ('hourly','daily')),
+    daily_time TEXT,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, kind)
+) WITHOUT ROWID
+"""
+
+async def _migrate_legacy_subs():
+    # Старая схема с id AUTOINCREMENT: переносим данные, при дублях остаётся последняя запись
+    async with DB.execute("SELECT 1 FROM pragma_table_info('subs') WHERE name='id'") as cur:
+        if await cur.fetchone() is None:
+            return
+    await DB.executescript(
+        "BEGIN IMMEDIATE;"
+        + SUBS_SCHEMA.format(table="subs_new") + ";"
+        + """
+        INSERT OR REPLACE INTO subs_new(user_id, chat_id, kind, daily_time, created_at)
+            SELECT user_id, chat_id, kind, daily_time, created_at FROM subs ORDER BY id;
+        DROP TABLE subs;
+        ALTER TABLE subs_new RENAME TO subs;
+        DELETE FROM sqlite_sequence WHERE name='subs';
+        COMMIT;
+        """
+    )
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS subs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                chat_id INTEGER NOT NULL,
-                kind TEXT NOT NULL CHECK(kind IN ('hourly','daily')),
-                daily_time TEXT,
-                created_at TEXT NOT NULL
-            )
-            """
-        )
-        await db.commit()
+    # WAL: чтение в notifier_loop не блокируется записями от команд подписки
+    await DB.execute("PRAGMA journal_mode=WAL")
+    await _migrate_legacy_subs()
+    await DB.execute(SUBS_SCHEMA.format(table="subs"))
+    # Получателей по времени ищет индекс в памяти (HOURLY/DAILY), запросы по user_id — первичный ключ;
+    # индекс по (kind, daily_time) никто не читает, а поддерживать его пришлось бы на каждой записи
+    await DB.execute("DROP INDEX IF EXISTS idx_subs_kind_time")
+    await DB.commit()
 
 # ---- Курсы валют ----
+# Общий HTTP-клиент: keep-alive и HTTP/2 вместо нового TLS-рукопожатия на каждый запрос.
+# Создаётся в main(), закрывается при остановке.
+HTTP: httpx.AsyncClient | None = None
+
+def make_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(http2=True, timeout=10, limits=httpx.Limits(max_keepalive_connections=20))
+
+# Последняя цена TON из потока bookTicker; REST используется, только если поток молчит дольше 10 с
+TON_STREAM_MAX_AGE = 10  # секунд
+_ton_stream = {"price": None, "ts": 0.0}
+
+async def ton_stream_loop():
+    delay = 1
+    while True:
+        try:
+            async with websockets.connect(BINANCE_TON_STREAM) as ws:
+                delay = 1
+                async for raw in ws:
+                    m = orjson.loads(raw)
+                    _ton_stream["price"] = (float(m["b"]) + float(m["a"])) / 2  # середина спреда
+                    _ton_stream["ts"] = time.monotonic()
+        except Exception as e:
+            print("TON stream error:", e)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
 async def fetch_ton_usd(client: httpx.AsyncClient) -> float:
+    if _ton_stream["price"] is not None and time.monotonic() - _ton_stream["ts"] < TON_STREAM_MAX_AGE:
+        return _ton_stream["price"]
     r = await client.get(BINANCE_TICKER, timeout=10)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     return float(data["price"])  # USDT ~ USD
 
+# USD→RUB меняется медленно и источник обновляет его не чаще раза в час — держим 10 минут
+FX_TTL = 600  # секунд
+_fx_cache = {"ts": 0.0, "val": None}
+
 async def fetch_usd_rub(client: httpx.AsyncClient) -> float:
-    r = await client.get("https://open.er-api.com/v6/latest/USD", timeout=10)
+    if _fx_cache["val"] is not None and time.monotonic() - _fx_cache["ts"] < FX_TTL:
+        return _fx_cache["val"]
+    r = await client.get(FX_USD_RUB, timeout=10)
     r.raise_for_status()
-    data = r.json()
-    
+    data = orjson.loads(r.content)
+
     if "rates" in data and "RUB" in data["rates"]:
-        return float(data["rates"]["RUB"])
+        _fx_cache["val"] = float(data["rates"]["RUB"])
+        _fx_cache["ts"] = time.monotonic()
+        return _fx_cache["val"]
     raise ValueError(f"Unexpected response: {data}")
 
-async def get_rates() -> dict:
-    async with httpx.AsyncClient() as client:
-        ton_usd, usd_rub = await asyncio.gather(
-            fetch_ton_usd(client),
-            fetch_usd_rub(client),
-        )
+# Повторы при сбоях источника: 3 попытки с экспоненциальной задержкой и джиттером (1–5 с)
+FETCH_ATTEMPTS = 3
+RETRY_ERRORS = (httpx.HTTPError, ValueError, KeyError)
+
+async def _with_retry(fetch, client: httpx.AsyncClient) -> float:
+    for attempt in range(FETCH_ATTEMPTS):
+        try:
+            return await fetch(client)
+        except RETRY_ERRORS:
+            if attempt == FETCH_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(min(2 ** attempt, 5) + random.uniform(0, 1))
+
+async def _fetch_rates() -> dict:
+    ton_usd, usd_rub = await asyncio.gather(
+        _with_retry(fetch_ton_usd, HTTP),
+        _with_retry(fetch_usd_rub, HTTP),
+    )
     ton_rub = ton_usd * usd_rub
     return {"ton_usd": ton_usd, "usd_rub": usd_rub, "ton_rub": ton_rub, "ts": datetime.now(timezone.utc)}
 
+# Кэш последних курсов: тик планировщика и одновременные /rate делят один запрос к источникам
+RATES_TTL = 30  # секунд
+_rate_cache = {"ts": 0.0, "val": None, "stale": None}
+_rate_lock = asyncio.Lock()
+
+# Предохранитель: больше 3 неудачных обновлений за 5 минут — не ходим к источникам,
+# отдаём последние курсы с пометкой stale, пока старые сбои не выйдут из окна
+BREAKER_THRESHOLD = 3
+BREAKER_WINDOW = 300  # секунд
+_fetch_failures: deque[float] = deque()
+# Последняя неудачная попытка: ждавшие блокировку получают её результат, а не повторяют запрос
+_last_failure = {"ts": 0.0, "error": None}
+
+def _rates_fresh() -> bool:
+    return _rate_cache["val"] is not None and time.monotonic() - _rate_cache["ts"] < RATES_TTL
+
+def _breaker_open() -> bool:
+    now = time.monotonic()
+    while _fetch_failures and now - _fetch_failures[0] > BREAKER_WINDOW:
+        _fetch_failures.popleft()
+    return len(_fetch_failures) > BREAKER_THRESHOLD
+
+def _stale_rates() -> dict:
+    if _rate_cache["stale"] is None:
+        _rate_cache["stale"] = {**_rate_cache["val"], "stale": True}
+    return _rate_cache["stale"]
+
+async def get_rates(force: bool = False) -> dict:
+    if not force and _rates_fresh():
+        return _rate_cache["val"]
+    waiting_since = time.monotonic()
+    async with _rate_lock:
+        # Пока ждали блокировку, курсы мог уже обновить другой запрос
+        if not force and _rates_fresh():
+            return _rate_cache["val"]
+        have_cached = _rate_cache["val"] is not None
+        # ...или другой запрос только что безуспешно попытался — не ждём ещё один полный цикл повторов
+        if _last_failure["ts"] >= waiting_since:
+            if not have_cached:
+                raise _last_failure["error"]
+            return _stale_rates()
+        if have_cached and _breaker_open():
+            return _stale_rates()
+        try:
+            rates = await _fetch_rates()
+        except Exception as e:
+            _fetch_failures.append(time.monotonic())
+            _last_failure["ts"] = time.monotonic()
+            _last_failure["error"] = e
+            if not have_cached:
+                raise
+            return _stale_rates()
+        _fetch_failures.clear()
+        _rate_cache["ts"] = time.monotonic()
+        _rate_cache["val"] = rates
+        _rate_cache["stale"] = None
+        return rates
+
 # ---- Форматирование ----
 
+# Последний отформатированный текст: пока get_rates() отдаёт тот же кэшированный dict,
+# тик планировщика, /rate и «Обновить» используют одну строку
+_fmt_cache: dict = {"rates": None, "text": ""}
+
 def fmt_rates(r: dict) -> str:
+    if _fmt_cache["rates"] is r:
+        return _fmt_cache["text"]
+    text = _render_rates(r)
+    _fmt_cache["rates"] = r
+    _fmt_cache["text"] = text
+    return text
+
+# Формат постоянный, в нём только числа и дата — HTML-экранирование не требуется
+RATES_TEMPLATE = (
+    "<b>Курсы сейчас</b>\n"
+    "• USD → RUB: {usd_rub:.2f}\n"
+    "• TON → USD: {ton_usd:.4f}\n"
+    "• TON → RUB: {ton_rub:.2f}\n"
+    "\n"
+    "Обновлено: {ts}{stale}"
+)
+
+def _render_rates(r: dict) -> str:
     ts = r["ts"].astimezone().strftime("%Y-%m-%d %H:%M:%S")
-    ton_usd = f"{r['ton_usd']:.4f}"
-    usd_rub = f"{r['usd_rub']:.2f}"
-    ton_rub = f"{r['ton_rub']:.2f}"
-    section = as_marked_section(
-        Bold("Курсы сейчас"),
-        f"USD → RUB: {usd_rub}",
-        f"TON → USD: {ton_usd}",
-        f"TON → RUB: {ton_rub}",
-        marker="• ",
-    )
-    return "\n".join([section.as_html(), "", f"Обновлено: {ts}"])
+    stale = " (кэш)" if r.get("stale") else ""
+    return RATES_TEMPLATE.format(usd_rub=r["usd_rub"], ton_usd=r["ton_usd"], ton_rub=r["ton_rub"], ts=ts, stale=stale)
 
 
 def refresh_keyboard() -> InlineKeyboardMarkup:
@@ -105,17 +299,32 @@ def refresh_keyboard() -> InlineKeyboardMarkup:
 
 # ---- Меню подписок пользователя ----
 
+# Разделитель не ":", потому что двоеточие есть во времени HH:MM
+class SubCB(CallbackData, prefix="s", sep="|"):
+    kind: str
+    time: str = ""
+
 def subscribe_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⏱ Почасовая", callback_data="sub:hourly")],
-        [InlineKeyboardButton(text="🗓 Ежедневно 09:00 UTC", callback_data="sub:daily:09:00")],
-        [InlineKeyboardButton(text="🗓 Ежедневно 12:00 UTC", callback_data="sub:daily:12:00")],
-        [InlineKeyboardButton(text="🗓 Ежедневно 18:00 UTC", callback_data="sub:daily:18:00")],
+        [InlineKeyboardButton(text="⏱ Почасовая", callback_data=SubCB(kind="hourly").pack())],
+        [InlineKeyboardButton(text="🗓 Ежедневно 09:00 UTC", callback_data=SubCB(kind="daily", time="09:00").pack())],
+        [InlineKeyboardButton(text="🗓 Ежедневно 12:00 UTC", callback_data=SubCB(kind="daily", time="12:00").pack())],
+        [InlineKeyboardButton(text="🗓 Ежедневно 18:00 UTC", callback_data=SubCB(kind="daily", time="18:00").pack())],
         [InlineKeyboardButton(text="❌ Отписаться от всех", callback_data="unsub:all")],
     ])
 
 # ---- Все команды ----
 
+# Время подписки HH:MM (UTC); час допускается и одной цифрой: 9:00 == 09:00
+TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+
+def _parse_time(s: str) -> str | None:
+    """Возвращает время в каноничном виде HH:MM (как strftime("%H:%M")) или None."""
+    m = TIME_RE.match(s)
+    if not m:
+        return None
+    return f"{int(m[1]):02d}:{m[2]}"
+
 @dp.message(Command("start"))
 async def cmd_start(msg: Message):
     text = (
@@ -125,7 +334,7 @@ async def cmd_start(msg: Message):
         "• /subscribe — оформить подписку (почасовую или ежедневную)\n"
         "• /unsubscribe — отменить все подписки\n"
         "• /mysubs — показать активные подписки\n\n"
-        "Источник: Binance (TONUSDT) и exchangerate.host."
+        "Источник: Binance (TONUSDT) и open.er-api.com."
     )
     await msg.answer(text)
 
@@ -143,6 +352,12 @@ async def cb_refresh(call: CallbackQuery):
         rates = await get_rates()
         await call.message.edit_text(fmt_rates(rates), reply_markup=refresh_keyboard())
         await call.answer("Обновлено")
+    except TelegramBadRequest as e:
+        # Курсы отдаются из кэша — текст тот же, и Telegram отказывается его «редактировать»
+        if "message is not modified" in str(e):
+            await call.answer("Курсы не изменились")
+        else:
+            await call.answer("Ошибка обновления", show_alert=True)
     except Exception as e:
         await call.answer("Ошибка обновления", show_alert=True)
 
@@ -179,38 +394,46 @@ async def cmd_subscribe_daily(msg: Message):
     if len(parts) < 2:
         await msg.answer("Укажите время в формате HH:MM, например: /subscribe_daily 09:00 (UTC)")
         return
-    time_str = parts[1]
-    if time_str.count(":") != 1:
-        await msg.answer("Нужно HH:MM (UTC)")
-        return
-    hh_str, mm_str = time_str.split(":")
-    if not (hh_str.isdigit() and mm_str.isdigit()):
-        await msg.answer("Часы и минуты должны быть числами")
-        return
-    hh = int(hh_str)
-    mm = int(mm_str)
-    if not (0 <= hh <= 23 and 0 <= mm <= 59):
-        await msg.answer("Допустимо 00:00–23:59 (UTC)")
+    time_str = _parse_time(parts[1])
+    if not time_str:
+        await msg.answer("Нужно HH:MM, допустимо 00:00–23:59 (UTC)")
         return
-    await add_sub(user_id=msg.from_user.id, chat_id=msg.chat.id, kind="daily", daily_time=f"{hh:02d}:{mm:02d}")
-    await msg.answer(f"Готово! Ежедневная подписка в {hh:02d}:{mm:02d} UTC оформлена.")
+    await add_sub(user_id=msg.from_user.id, chat_id=msg.chat.id, kind="daily", daily_time=time_str)
+    await msg.answer(f"Готово! Ежедневная подписка в {time_str} UTC оформлена.")
 
 @dp.callback_query(F.data == "sub:menu")
 async def cb_sub_menu(call: CallbackQuery):
     await call.message.edit_reply_markup(reply_markup=subscribe_menu())
     await call.answer()
 
-@dp.callback_query(F.data == "sub:hourly")
-async def cb_sub_hourly(call: CallbackQuery):
+@dp.callback_query(SubCB.filter(F.kind == "hourly"))
+async def cb_sub_hourly(call: CallbackQuery, callback_data: SubCB):
     await add_sub(user_id=call.from_user.id, chat_id=call.message.chat.id, kind="hourly")
     await call.answer("Почасовая подписка оформлена.", show_alert=True)
 
-@dp.callback_query(F.data.startswith("sub:daily:"))
-async def cb_sub_daily(call: CallbackQuery):
-    time_str = call.data.split(":", 2)[2]
+@dp.callback_query(SubCB.filter(F.kind == "daily"))
+async def cb_sub_daily(call: CallbackQuery, callback_data: SubCB):
+    time_str = _parse_time(callback_data.time)
+    if not time_str:
+        await call.answer("Некорректное время.", show_alert=True)
+        return
     await add_sub(user_id=call.from_user.id, chat_id=call.message.chat.id, kind="daily", daily_time=time_str)
     await call.answer(f"Ежедневно в {time_str} UTC.", show_alert=True)
 
+# Клавиатуры, отправленные до перехода на SubCB, присылают "sub:hourly" / "sub:daily:HH:MM".
+# Регистрируется после "sub:menu", поэтому меню сюда не попадает.
+@dp.callback_query(F.data.startswith("sub:"))
+async def cb_sub_legacy(call: CallbackQuery):
+    # Переводим старую строку в SubCB и отдаём тем же обработчикам, что и новые кнопки
+    if call.data == "sub:hourly":
+        await cb_sub_hourly(call, SubCB(kind="hourly"))
+        return
+    if call.data.startswith("sub:daily:"):
+        await cb_sub_daily(call, SubCB(kind="daily", time=call.data.removeprefix("sub:daily:")))
+        return
+    await call.message.edit_reply_markup(reply_markup=subscribe_menu())
+    await call.answer("Выберите подписку ещё раз.")
+
 @dp.callback_query(F.data == "unsub:all")
 async def cb_unsub_all(call: CallbackQuery):
     await remove_all_subs(call.from_user.id)
@@ -218,61 +441,167 @@ async def cb_unsub_all(call: CallbackQuery):
 
 # ---- Работы с Базой Данных  ----
 
+# Копия подписок в памяти для планировщика: тик — это поиск в dict, без запросов к БД.
+# Источник истины — БД; кэш заполняется при старте и обновляется после каждого commit.
+HOURLY: dict[int, int] = {}             # user_id -> chat_id
+DAILY: dict[str, dict[int, int]] = {}   # "HH:MM" -> {user_id: chat_id}
+DAILY_TIME: dict[int, str] = {}         # user_id -> "HH:MM"
+
+def _cache_add(user_id: int, chat_id: int, kind: str, daily_time: str | None):
+    if kind == "hourly":
+        HOURLY[user_id] = chat_id
+        return
+    _cache_drop_daily(user_id)
+    DAILY.setdefault(daily_time, {})[user_id] = chat_id
+    DAILY_TIME[user_id] = daily_time
+
+def _cache_drop_daily(user_id: int):
+    old_time = DAILY_TIME.pop(user_id, None)
+    if old_time is None:
+        return
+    bucket = DAILY[old_time]
+    bucket.pop(user_id, None)
+    if not bucket:
+        del DAILY[old_time]
+
+def _cache_remove_user(user_id: int):
+    HOURLY.pop(user_id, None)
+    _cache_drop_daily(user_id)
+
+async def _reload_cache():
+    HOURLY.clear()
+    DAILY.clear()
+    DAILY_TIME.clear()
+    async with acquire_reader() as db:
+        # Полный скан таблицы — читаем потоково, не собирая все строки в список
+        async with db.execute("SELECT user_id, chat_id, kind, daily_time FROM subs") as cur:
+            async for user_id, chat_id, kind, daily_time in cur:
+                _cache_add(user_id, chat_id, kind, daily_time)
+
+def _recipients(minute: int, time_hhmm: str) -> set[int]:
+    chats = set(HOURLY.values()) if minute == 0 else set()
+    chats.update(DAILY.get(time_hhmm, {}).values())
+    return chats
+
 async def add_sub(user_id: int, chat_id: int, kind: str, daily_time: str | None = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        if kind == "daily" and not daily_time:
-            raise ValueError("daily_time обязателен для daily")
-        if kind == "hourly":
-            await db.execute("DELETE FROM subs WHERE user_id=? AND kind='hourly'", (user_id,))
-        else:
-            await db.execute("DELETE FROM subs WHERE user_id=? AND kind='daily'", (user_id,))
-        await db.execute(
-            "INSERT INTO subs(user_id, chat_id, kind, daily_time, created_at) VALUES(?,?,?,?,?)",
-            (user_id, chat_id, kind, daily_time, datetime.now(timezone.utc).isoformat()),
-        )
-        await db.commit()
+    if kind == "daily" and not daily_time:
+        raise ValueError("daily_time обязателен для daily")
+    async with DB_WRITE_LOCK:
+        # Берём блокировку на запись сразу, чтобы не ловить SQLITE_BUSY при её повышении
+        await DB.execute("BEGIN IMMEDIATE")
+        try:
+            # Первичный ключ (user_id, kind): REPLACE заменяет прежнюю подписку того же вида
+            await DB.execute(
+                "INSERT OR REPLACE INTO subs(user_id, chat_id, kind, daily_time, created_at) VALUES(?,?,?,?,?)",
+                (user_id, chat_id, kind, daily_time, datetime.now(timezone.utc).isoformat()),
+            )
+            await DB.commit()
+        except Exception:
+            # Соединение общее — не оставляем его с открытой транзакцией
+            await DB.rollback()
+            raise
+        _cache_add(user_id, chat_id, kind, daily_time)
 
 async def remove_all_subs(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("DELETE FROM subs WHERE user_id=?", (user_id,))
-        await db.commit()
+    async with DB_WRITE_LOCK:
+        try:
+            cur = await DB.execute("DELETE FROM subs WHERE user_id=?", (user_id,))
+            await DB.commit()
+        except Exception:
+            await DB.rollback()
+            raise
+        _cache_remove_user(user_id)
         return cur.rowcount
 
 async def list_subs(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT kind, daily_time FROM subs WHERE user_id=? ORDER BY kind", (user_id,))
-        rows = await cur.fetchall()
-        return [{"kind": r[0], "daily_time": r[1]} for r in rows]
+    async with acquire_reader() as db:
+        async with db.execute("SELECT kind, daily_time FROM subs WHERE user_id=? ORDER BY kind", (user_id,)) as cur:
+            rows = await cur.fetchall()
+    return [{"kind": r[0], "daily_time": r[1]} for r in rows]
 
 # ---- Планировщик уведомлений ----
 
+# Telegram допускает ~30 сообщений в секунду на бота: 30 слотов, каждый занят не меньше секунды
+SEND_SEMAPHORE = asyncio.Semaphore(30)
+# 429 от Telegram — пауза для всех отправок сразу, а не только для получившей ответ
+_send_paused_until = {"ts": 0.0}
+
+async def _send(chat_id: int, text: str):
+    async with SEND_SEMAPHORE:
+        started = time.monotonic()
+        try:
+            while True:
+                pause = _send_paused_until["ts"] - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                try:
+                    await bot.send_message(chat_id, text)
+                    return
+                except TelegramRetryAfter as e:
+                    _send_paused_until["ts"] = max(_send_paused_until["ts"], time.monotonic() + e.retry_after)
+        finally:
+            await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - started)))
+
+def _seconds_to_next_minute() -> float:
+    now = datetime.now(timezone.utc)
+    delay = 60 - (now.second + now.microsecond / 1e6)
+    return min(max(delay, 1.0), 60.0)
+
+# Сколько пропущенных минут догоняем после долгого тика (медленный HTTP, повторы)
+MAX_CATCHUP_MINUTES = 15
+
 async def notifier_loop():
+    last_tick: datetime | None = None
     while True:
         try:
-            now_utc = datetime.now(timezone.utc)
-            minute = now_utc.minute
-            time_hhmm = now_utc.strftime("%H:%M")
-            rates = await get_rates()
-            async with aiosqlite.connect(DB_PATH) as db:
-                if minute == 0:
-                    async with db.execute("SELECT DISTINCT chat_id FROM subs WHERE kind='hourly'") as cur:
-                        for row in await cur.fetchall():
-                            await bot.send_message(row[0], fmt_rates(rates))
-                async with db.execute("SELECT DISTINCT chat_id FROM subs WHERE kind='daily' AND daily_time=?", (time_hhmm,)) as cur:
-                    for row in await cur.fetchall():
-                        await bot.send_message(row[0], fmt_rates(rates))
+            tick = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+            # Защита от повторной рассылки, если таймер проснулся чуть раньше границы минуты
+            if last_tick is not None and tick <= last_tick:
+                continue
+            # Если прошлый тик затянулся дольше минуты — собираем получателей и за пропущенные минуты
+            first = tick if last_tick is None else max(last_tick + timedelta(minutes=1),
+                                                       tick - timedelta(minutes=MAX_CATCHUP_MINUTES))
+            last_tick = tick
+            recipients: set[int] = set()
+            while first <= tick:
+                recipients |= _recipients(first.minute, first.strftime("%H:%M"))
+                first += timedelta(minutes=1)
+            # Большинство минут получателей нет — тогда не ходим за курсами вовсе
+            chats = list(recipients)
+            if not chats:
+                continue
+            rates = await get_rates(force=False)
+            text = fmt_rates(rates)
+            results = await asyncio.gather(*(_send(chat_id, text) for chat_id in chats), return_exceptions=True)
+            for chat_id, res in zip(chats, results):
+                if isinstance(res, Exception):
+                    print(f"Notifier send error ({chat_id}):", res)
         except Exception as e:
             print("Notifier error:", e)
         finally:
-            await asyncio.sleep(60)
+            # Просыпаемся в начале следующей минуты, а не через 60 с — иначе накапливается дрейф
+            await asyncio.sleep(_seconds_to_next_minute())
 
 # ---- Entrypoint ----
 
 async def main():
+    global DB, HTTP
     print("Bot starting…")
-    await init_db()
-    asyncio.create_task(notifier_loop())
-    await dp.start_polling(bot)
+    DB = await open_db()
+    HTTP = make_http_client()
+    try:
+        await init_db()
+        await open_readers()
+        await _reload_cache()
+        asyncio.create_task(ton_stream_loop())
+        asyncio.create_task(notifier_loop())
+        # Длинный getUpdates: в простое один запрос к Telegram раз в 25 с;
+        # апдейты обрабатываются задачами и не задерживают следующий getUpdates
+        await dp.start_polling(bot, polling_timeout=25, handle_as_tasks=True)
+    finally:
+        await HTTP.aclose()
+        await close_readers()
+        await DB.close()
 
 if __name__ == "__main__":
     try:
@@ -282,9 +611,11 @@ if __name__ == "__main__":
 
 # ----- Файл: requirements.txt -----
 # aiogram>=3.7
-# httpx>=0.27.0
+# httpx[http2]>=0.27.0
 # python-dotenv>=1.0.1
 # aiosqlite>=0.20.0
+# websockets>=12.0
+# orjson>=3.9
 
 # ----- Файл: .env.example -----
 # BOT_TOKEN=1234567890:ABCDEF-your-telegram-bot-token